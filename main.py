@@ -6,7 +6,16 @@ import hmac
 import hashlib
 import uuid
 import asyncio
-from aiohttp import web, ClientSession
+import heapq
+import threading
+import time
+import io
+import random
+import cProfile
+import pstats
+import contextvars
+from contextlib import contextmanager
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
@@ -15,11 +24,14 @@ from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, ConversationHandler, filters, ContextTypes,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 import gspread
 from google.oauth2.service_account import Credentials
 from google.auth.transport.requests import AuthorizedSession
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
 from datetime import datetime
 from zoneinfo import ZoneInfo  # Імпорт для роботи з часовою зоною Києва
 from dotenv import load_dotenv
@@ -30,18 +42,81 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONOPAY_TOKEN = os.getenv("MONOPAY_TOKEN")
 MONOPAY_WEBHOOK_SECRET = os.getenv("MONOPAY_WEBHOOK_SECRET", None)
+MONOPAY_API_URL = os.getenv("MONOPAY_API_URL", "https://api.monobank.ua").rstrip("/")
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", 120))
+RECONCILE_MIN_AGE_MINUTES = int(os.getenv("RECONCILE_MIN_AGE_MINUTES", 5))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", 5))
+PENDING_WORKSHEET = "pending"
+PENDING_ORDER_FIELDS = (
+    "invoice_id", "chat_id", "book", "location", "genre", "days",
+    "name", "contact", "hold_id", "created_at", "amount",
+)
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+STATS_API_TOKEN = os.getenv("STATS_API_TOKEN")
+STATS_CHUNK_ROWS = int(os.getenv("STATS_CHUNK_ROWS", 500))
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", 60))
+PROFILE_MAX_SECONDS = 300
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 10000))
+ORDERS_REFRESH_INTERVAL = int(os.getenv("ORDERS_REFRESH_INTERVAL", 600))
+RECOMMEND_TOP_K = int(os.getenv("RECOMMEND_TOP_K", 5))
+RECOMMEND_SHOWN = 3
+RECOMMEND_AUTHOR_WEIGHT = 0.5
 WEBHOOK_URL = os.getenv("WEBHOOK_URL").rstrip("/")
 PORT = int(os.getenv("PORT", 8443))
 GOOGLE_SHEET_ID_LOCATIONS = os.getenv("GOOGLE_SHEET_ID_LOCATIONS")
 GOOGLE_SHEET_ID_ORDERS = os.getenv("GOOGLE_SHEET_ID_ORDERS")
+HOLD_TTL_SECONDS = int(os.getenv("HOLD_TTL_SECONDS", 900))
+AVAILABILITY_SWEEP_INTERVAL = int(os.getenv("AVAILABILITY_SWEEP_INTERVAL", 30))
+RENTAL_RETURN_GRACE_DAYS = int(os.getenv("RENTAL_RETURN_GRACE_DAYS", 14))
+ORDER_COLUMNS = [
+    "location", "author", "title", "genre", "days", "name", "contact",
+    "order_datetime", "invoice_id", "chat_id", "returned_at",
+    "reminded_soon", "reminded_overdue", "amount",
+]
+REMINDER_LEAD_HOURS = int(os.getenv("REMINDER_LEAD_HOURS", 24))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 25))
+REMINDER_BATCH_DELAY = float(os.getenv("REMINDER_BATCH_DELAY", 1.0))
+REMINDER_MISSED_GRACE_HOURS = int(os.getenv("REMINDER_MISSED_GRACE_HOURS", 72))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", 5))
 creds_dict = json.loads(os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON"))
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
+# Профілювання: вмикається адміном через /profile
+profiling_enabled = os.getenv("PROFILING", "0") == "1"
+webhook_log_sample_rate = float(os.getenv("WEBHOOK_LOG_SAMPLE_RATE", 1.0))
+profile_capture_task = None
+last_profile_report = ""
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+@contextmanager
+def trace_span(name: str):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace[name] = trace.get(name, 0.0) + time.perf_counter() - t0
+
+def should_log_webhook() -> bool:
+    return webhook_log_sample_rate >= 1.0 or random.random() < webhook_log_sample_rate
+
+class TracingAuthorizedSession(AuthorizedSession):
+    def request(self, *args, **kwargs):
+        with trace_span("sheets"):
+            return super().request(*args, **kwargs)
+
+class TracingRequest(HTTPXRequest):
+    async def do_request(self, *args, **kwargs):
+        with trace_span("bot_api"):
+            return await super().do_request(*args, **kwargs)
+
 credentials = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-gc = gspread.Client(auth=credentials)
-gc.session = AuthorizedSession(credentials)
+gc = gspread.Client(auth=credentials, session=TracingAuthorizedSession(credentials))
 
 (
     START_MENU,
@@ -67,8 +142,45 @@ location_to_books = {}
 author_to_books = {}
 author_to_books_normalized = {}
 rental_price_map = {}
+title_to_book = {}
 
 pending_orders = {}
+pending_worksheet = None
+pending_sheet_lock = threading.Lock()
+
+# Відбитки останнього вмісту кожного повідомлення: (chat_id, message_id) -> fingerprint
+render_fingerprints = OrderedDict()
+render_stats = {"sent": 0, "skipped": 0}
+monopay_session = None
+
+# Аналітика замовлень: інкрементальні агрегати поверх потокового читання аркуша
+orders_header = []
+orders_rows_read = 0
+order_stats = {"total": {"rentals": 0, "revenue": 0}, "location": {}, "genre": {}, "title": {}, "day": {}}
+orders_ingest_lock = threading.Lock()
+stats_cache = {"at": 0.0, "data": None}
+chat_rentals = {}  # chat_id -> set(title)
+
+# "Вам також може сподобатися": готова таблиця top-k, перебудовується лише при зміні даних
+recommendations = {}
+recommendations_signature = None
+recommendations_task = None
+
+# Індекс доступності примірників: (location, title) -> лічильники
+copy_totals = {}
+copy_out = {}
+reservation_holds = {}  # hold_id -> ((location, title), expires_at)
+active_rentals = {}  # invoice_id -> ((location, title), release_at)
+availability_expiry_heap = []  # (expires_at, kind, id)
+availability_lock = threading.Lock()
+
+# Фонові задачі тримаємо тут, щоб їх не зібрав GC і щоб скасувати при зупинці
+background_tasks = []
+
+# Нагадування про повернення: одна купа таймерів і одна фонова задача
+reminder_heap = []  # (fire_at, seq, kind, payload)
+reminder_seq = 0
+reminder_wakeup = asyncio.Event()
 
 def normalize_str(s: str) -> str:
     return s.strip().lower() if s else ""
@@ -92,8 +204,352 @@ def make_book_callback_data(title: str) -> str:
     h = hashlib.sha256(title.encode('utf-8')).hexdigest()[:16]
     return f"book:{h}"
 
+def _rebuild_copy_out_locked():
+    copy_out.clear()
+    for key, _ in reservation_holds.values():
+        copy_out[key] = copy_out.get(key, 0) + 1
+    for key, _ in active_rentals.values():
+        copy_out[key] = copy_out.get(key, 0) + 1
+
+def rebuild_availability(totals: dict):
+    # Броні та оренди переживають перезавантаження каталогу
+    with availability_lock:
+        copy_totals.clear()
+        copy_totals.update(totals)
+        _rebuild_copy_out_locked()
+
+def available_copies(location: str, title: str) -> int:
+    key = (location, title)
+    return copy_totals.get(key, 0) - copy_out.get(key, 0)
+
+def is_available(title: str, location: str | None = None) -> bool:
+    if location:
+        return available_copies(location, title) > 0
+    return any(available_copies(loc, title) > 0 for loc in book_to_locations.get(title, []))
+
+def pick_location_with_copy(title: str) -> str | None:
+    for loc in book_to_locations.get(title, []):
+        if available_copies(loc, title) > 0:
+            return loc
+    return None
+
+def place_hold(hold_id: str, location: str, title: str, ttl: int = HOLD_TTL_SECONDS) -> bool:
+    key = (location, title)
+    expires_at = time.time() + ttl
+    with availability_lock:
+        if copy_totals.get(key, 0) - copy_out.get(key, 0) <= 0:
+            return False
+        reservation_holds[hold_id] = (key, expires_at)
+        copy_out[key] = copy_out.get(key, 0) + 1
+        heapq.heappush(availability_expiry_heap, (expires_at, "hold", hold_id))
+    return True
+
+def release_hold(hold_id: str) -> bool:
+    with availability_lock:
+        entry = reservation_holds.pop(hold_id, None)
+        if not entry:
+            return False
+        key = entry[0]
+        copy_out[key] = max(copy_out.get(key, 0) - 1, 0)
+    return True
+
+def add_rental(invoice_id: str, location: str, title: str, due_at: float):
+    # Повернення фіксує адмін через /returned; без нього примірник вважається
+    # зайнятим ще RENTAL_RETURN_GRACE_DAYS після терміну оренди
+    key = (location, title)
+    release_at = due_at + RENTAL_RETURN_GRACE_DAYS * 86400
+    with availability_lock:
+        if invoice_id in active_rentals:
+            return
+        active_rentals[invoice_id] = (key, release_at)
+        copy_out[key] = copy_out.get(key, 0) + 1
+        heapq.heappush(availability_expiry_heap, (release_at, "rental", invoice_id))
+
+def release_rental(invoice_id: str) -> tuple | None:
+    with availability_lock:
+        entry = active_rentals.pop(invoice_id, None)
+        if not entry:
+            return None
+        key = entry[0]
+        copy_out[key] = max(copy_out.get(key, 0) - 1, 0)
+    return key
+
+def convert_hold_to_rental(hold_id: str, invoice_id: str, location: str, title: str, days: int) -> float:
+    due_at = time.time() + days * 86400
+    with availability_lock:
+        entry = reservation_holds.pop(hold_id, None)
+        if entry:
+            key = entry[0]
+            copy_out[key] = max(copy_out.get(key, 0) - 1, 0)
+    if not entry:
+        logger.warning(f"Hold {hold_id} for invoice {invoice_id} already expired, renting anyway")
+    add_rental(invoice_id, location, title, due_at)
+    if available_copies(location, title) < 0:
+        logger.error(f"Overbooked: \"{title}\" at \"{location}\" after invoice {invoice_id}")
+    return due_at
+
+def release_expired_availability(now: float | None = None) -> list:
+    now = now or time.time()
+    released = []
+    with availability_lock:
+        while availability_expiry_heap and availability_expiry_heap[0][0] <= now:
+            expires_at, kind, item_id = heapq.heappop(availability_expiry_heap)
+            store = reservation_holds if kind == "hold" else active_rentals
+            entry = store.get(item_id)
+            # Запис у купі може бути застарілим (бронь уже конвертована чи знята)
+            if not entry or entry[1] != expires_at:
+                continue
+            del store[item_id]
+            key = entry[0]
+            copy_out[key] = max(copy_out.get(key, 0) - 1, 0)
+            released.append((kind, item_id, key))
+    return released
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.append(task)
+    return task
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+async def notify_admin(bot, text: str):
+    if not ADMIN_CHAT_ID:
+        return
+    try:
+        await bot.send_message(int(ADMIN_CHAT_ID), text)
+    except Exception as e:
+        logger.error(f"Не вдалося надіслати повідомлення адміну: {e}")
+
+async def availability_sweeper(bot):
+    while True:
+        await asyncio.sleep(AVAILABILITY_SWEEP_INTERVAL)
+        try:
+            released = release_expired_availability()
+            if released:
+                logger.info(f"Звільнено {len(released)} прострочених бронювань/оренд")
+            rentals = [(item_id, key) for kind, item_id, key in released if kind == "rental"]
+            if rentals:
+                lines = [f"• {key[1]} — {key[0]} (інвойс {item_id})" for item_id, key in rentals]
+                await notify_admin(
+                    bot,
+                    f"⚠️ Повернення не підтверджено через {RENTAL_RETURN_GRACE_DAYS} дн. після терміну, "
+                    "книги знову показуються як доступні:\n" + "\n".join(lines),
+                )
+        except Exception as e:
+            logger.error(f"Помилка очищення бронювань: {e}", exc_info=True)
+
+def push_reminder(fire_at: float, kind: str, payload: dict):
+    global reminder_seq
+    reminder_seq += 1
+    heapq.heappush(reminder_heap, (fire_at, reminder_seq, kind, payload))
+
+def schedule_rental_reminders(invoice_id: str, chat_id: int, title: str, location: str, due_at: float, sent=()):
+    now = time.time()
+    payload = {"invoice_id": invoice_id, "chat_id": chat_id, "title": title, "location": location, "due_at": due_at}
+    earliest = reminder_heap[0][0] if reminder_heap else None
+    for kind, fire_at in (("soon", due_at - REMINDER_LEAD_HOURS * 3600), ("overdue", due_at)):
+        # Вже надіслані (відмітка в аркуші) пропускаємо; пропущені під час простою
+        # надсилаємо, якщо з моменту спрацювання минуло не більше REMINDER_MISSED_GRACE_HOURS
+        if kind in sent or fire_at <= now - REMINDER_MISSED_GRACE_HOURS * 3600:
+            continue
+        if kind == "soon" and due_at <= now:
+            continue
+        push_reminder(fire_at, kind, payload)
+    if reminder_heap and (earliest is None or reminder_heap[0][0] < earliest):
+        reminder_wakeup.set()
+
+def parse_order_datetime(value: str) -> datetime | None:
+    try:
+        dt = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo("Europe/Kyiv"))
+    return dt
+
+def load_active_rentals_from_orders() -> int:
+    worksheet = gc.open_by_key(GOOGLE_SHEET_ID_ORDERS).sheet1
+    ensure_orders_header(worksheet)
+    records = worksheet.get_all_records()
+    now = time.time()
+    loaded = 0
+    for row in records:
+        if str(row.get("returned_at", "")).strip():
+            continue
+        dt = parse_order_datetime(row.get("order_datetime", ""))
+        try:
+            days = int(row.get("days") or 0)
+        except ValueError:
+            continue
+        if not dt or not days:
+            continue
+        due_at = dt.timestamp() + days * 86400
+        if due_at + RENTAL_RETURN_GRACE_DAYS * 86400 <= now:
+            continue
+        invoice_id = str(row.get("invoice_id", ""))
+        title = row.get("title", "")
+        location = row.get("location", "")
+        add_rental(invoice_id, location, title, due_at)
+        chat_id = row.get("chat_id")
+        if chat_id:
+            sent = {kind for kind in ("soon", "overdue") if str(row.get(f"reminded_{kind}", "")).strip()}
+            schedule_rental_reminders(invoice_id, int(chat_id), title, location, due_at, sent)
+        loaded += 1
+    return loaded
+
+def format_time_left(seconds: float) -> str:
+    hours = round(seconds / 3600)
+    if hours < 1:
+        return "менш ніж за годину"
+    if hours < 24:
+        return f"через {hours} год."
+    days = round(hours / 24)
+    return "завтра" if days == 1 else f"через {days} дн."
+
+def reminder_text(kind: str, payload: dict) -> str:
+    if kind == "soon":
+        time_left = format_time_left(payload["due_at"] - time.time())
+        return (
+            f"⏰ Нагадування: термін оренди книги «{payload['title']}» спливає {time_left.rstrip('.')}.\n"
+            f"Будь ласка, поверни її на поличку \"{payload['location']}\" 🌿"
+        )
+    return (
+        f"📕 Термін оренди книги «{payload['title']}» уже минув.\n"
+        f"Будь ласка, поверни її на поличку \"{payload['location']}\" якнайшвидше — на неї чекають інші читачі 🤍"
+    )
+
+async def send_reminders_batched(bot, entries: list):
+    # Повернені книги (/returned) вже не в active_rentals
+    entries = [entry for entry in entries if entry[3]["invoice_id"] in active_rentals]
+
+    # Повертає (статус, затримка): sent / drop (бот заблоковано тощо) /
+    # retry (тимчасова помилка) / flood (RetryAfter від Telegram)
+    async def send_one(kind, payload):
+        try:
+            await bot.send_message(payload["chat_id"], reminder_text(kind, payload))
+            return "sent", 0.0
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            return "flood", delay
+        except (Forbidden, BadRequest) as e:
+            logger.warning(f"Нагадування для {payload['invoice_id']} не буде доставлено: {e}")
+            return "drop", 0.0
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати нагадування для {payload['invoice_id']}: {e}")
+            return "retry", min(60.0 * 2 ** payload.get("attempts", 0), 3600.0)
+
+    delivered = {"soon": [], "overdue": []}
+    requeued = 0
+    for i in range(0, len(entries), REMINDER_BATCH_SIZE):
+        batch = entries[i:i + REMINDER_BATCH_SIZE]
+        results = await asyncio.gather(*(send_one(kind, payload) for _, _, kind, payload in batch))
+        flood_wait = 0.0
+        for (_, _, kind, payload), (status, delay) in zip(batch, results):
+            if status == "sent":
+                delivered[kind].append(payload["invoice_id"])
+            elif status in ("retry", "flood"):
+                if status == "flood":
+                    flood_wait = max(flood_wait, delay)
+                attempts = payload.get("attempts", 0) + 1
+                if attempts >= REMINDER_MAX_ATTEMPTS:
+                    logger.error(f"Нагадування {kind} для {payload['invoice_id']} відкинуто після {attempts} спроб")
+                    continue
+                push_reminder(time.time() + delay, kind, {**payload, "attempts": attempts})
+                requeued += 1
+        if i + REMINDER_BATCH_SIZE < len(entries):
+            # RetryAfter — ліміт на весь бот, тож чекаємо і перед наступною порцією
+            await asyncio.sleep(max(REMINDER_BATCH_DELAY, flood_wait))
+    if requeued:
+        logger.warning(f"Нагадувань відкладено для повтору: {requeued}")
+    sent_at = datetime.now(ZoneInfo("Europe/Kyiv")).isoformat(sep=' ', timespec='seconds')
+    for kind, invoice_ids in delivered.items():
+        if not invoice_ids:
+            continue
+        try:
+            await asyncio.to_thread(mark_orders, f"reminded_{kind}", invoice_ids, sent_at)
+        except Exception as e:
+            logger.error(f"Не вдалося зберегти відмітку нагадувань ({kind}): {e}", exc_info=True)
+    logger.info(f"Надіслано нагадувань: {sum(len(ids) for ids in delivered.values())} з {len(entries)}")
+
+async def reminder_scheduler(bot):
+    while True:
+        now = time.time()
+        due = []
+        while reminder_heap and reminder_heap[0][0] <= now:
+            due.append(heapq.heappop(reminder_heap))
+        if due:
+            try:
+                await send_reminders_batched(bot, due)
+            except Exception as e:
+                logger.error(f"Помилка надсилання нагадувань: {e}", exc_info=True)
+            continue
+        timeout = reminder_heap[0][0] - now if reminder_heap else None
+        reminder_wakeup.clear()
+        try:
+            await asyncio.wait_for(reminder_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def get_monopay_session() -> ClientSession:
+    # Один пул з'єднань на всі запити до MonoPay
+    global monopay_session
+    if monopay_session is None or monopay_session.closed:
+        monopay_session = ClientSession(
+            connector=TCPConnector(limit=RECONCILE_CONCURRENCY * 2),
+            timeout=ClientTimeout(total=15),
+        )
+    return monopay_session
+
+async def close_monopay_session():
+    if monopay_session is not None and not monopay_session.closed:
+        await monopay_session.close()
+
+def render_fingerprint(text: str, reply_markup=None, parse_mode=None) -> str:
+    # Telegram обрізає пробіли по краях тексту, тому порівнюємо без них
+    markup = json.dumps(reply_markup.to_dict(), sort_keys=True, ensure_ascii=False) if reply_markup else ""
+    raw = f"{parse_mode or ''}\x00{text.strip()}\x00{markup}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+async def edit_message_cached(query, text: str, reply_markup=None, parse_mode=None):
+    message = query.message
+    key = (message.chat.id, message.message_id) if message else None
+    fingerprint = render_fingerprint(text, reply_markup, parse_mode)
+    previous = render_fingerprints.get(key) if key else None
+    if previous is None and message is not None and message.text is not None and parse_mode is None:
+        # Холодний кеш: поточний вміст повідомлення приходить разом із callback query
+        previous = render_fingerprint(message.text, message.reply_markup)
+    if previous == fingerprint:
+        render_stats["skipped"] += 1
+        if key:
+            render_fingerprints[key] = fingerprint
+            render_fingerprints.move_to_end(key)
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        render_stats["sent"] += 1
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            if key:
+                render_fingerprints.pop(key, None)
+            raise
+    except Exception:
+        # TimedOut/NetworkError: редагування могло застосуватися, старий відбиток уже ненадійний
+        if key:
+            render_fingerprints.pop(key, None)
+        raise
+    if key:
+        render_fingerprints[key] = fingerprint
+        render_fingerprints.move_to_end(key)
+        while len(render_fingerprints) > RENDER_CACHE_SIZE:
+            render_fingerprints.popitem(last=False)
+
 async def create_monopay_invoice(amount: int, description: str, order_id: str) -> tuple[str, str]:
-    url = "https://api.monobank.ua/api/merchant/invoice/create"
+    url = f"{MONOPAY_API_URL}/api/merchant/invoice/create"
     headers = {
         "X-Token": MONOPAY_TOKEN,
         "Content-Type": "application/json",
@@ -105,21 +561,118 @@ async def create_monopay_invoice(amount: int, description: str, order_id: str) -
         "orderId": order_id,
         "redirectUrl": f"{WEBHOOK_URL}/success",
         "webHookUrl": f"{WEBHOOK_URL}/monopay_callback",
+        "validity": HOLD_TTL_SECONDS,
     }
-    async with ClientSession() as session:
+    session = get_monopay_session()
+    with trace_span("monopay"):
         async with session.post(url, headers=headers, json=data) as resp:
             resp_json = await resp.json()
-            if resp.status == 200 and ("pageUrl" in resp_json or "invoiceUrl" in resp_json):
-                invoice_id = resp_json.get("invoiceId")
-                payment_url = resp_json.get("pageUrl") or resp_json.get("invoiceUrl")
-                return payment_url, invoice_id
-            else:
-                logger.error(f"MonoPay invoice creation error: {resp_json}")
-                raise Exception(f"Помилка створення інвойсу MonoPay: {resp_json}")
+            status = resp.status
+    if status == 200 and ("pageUrl" in resp_json or "invoiceUrl" in resp_json):
+        invoice_id = resp_json.get("invoiceId")
+        payment_url = resp_json.get("pageUrl") or resp_json.get("invoiceUrl")
+        return payment_url, invoice_id
+    else:
+        logger.error(f"MonoPay invoice creation error: {resp_json}")
+        raise Exception(f"Помилка створення інвойсу MonoPay: {resp_json}")
+
+async def fetch_monopay_invoice_status(invoice_id: str) -> str | None:
+    url = f"{MONOPAY_API_URL}/api/merchant/invoice/status"
+    headers = {"X-Token": MONOPAY_TOKEN}
+    session = get_monopay_session()
+    with trace_span("monopay"):
+        async with session.get(url, headers=headers, params={"invoiceId": invoice_id}) as resp:
+            resp_json = await resp.json()
+            status = resp.status
+    if status != 200:
+        logger.error(f"MonoPay invoice status error for {invoice_id}: {resp_json}")
+        return None
+    return resp_json.get("status")
+
+def ensure_orders_header(worksheet) -> list:
+    # Нові колонки дописуються в кінець заголовка, старі рядки лишаються як є
+    if not orders_header:
+        orders_header.extend(worksheet.row_values(1))
+    missing = [column for column in ORDER_COLUMNS if column not in orders_header]
+    if missing:
+        first = len(orders_header) + 1
+        worksheet.update(
+            range_name=f"{gspread.utils.rowcol_to_a1(1, first)}:{gspread.utils.rowcol_to_a1(1, first + len(missing) - 1)}",
+            values=[missing],
+        )
+        orders_header.extend(missing)
+    return orders_header
+
+def mark_orders(column: str, invoice_ids, value) -> int:
+    worksheet = gc.open_by_key(GOOGLE_SHEET_ID_ORDERS).sheet1
+    header = ensure_orders_header(worksheet)
+    invoice_col = header.index("invoice_id") + 1
+    target_col = header.index(column) + 1
+    wanted = {str(invoice_id) for invoice_id in invoice_ids}
+    updates = []
+    for row_idx, invoice_id in enumerate(worksheet.col_values(invoice_col)[1:], start=2):
+        if invoice_id in wanted:
+            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, target_col), "values": [[value]]})
+    if updates:
+        worksheet.batch_update(updates)
+    return len(updates)
+
+def get_pending_worksheet():
+    # Неоплачені замовлення дублюються в окремий аркуш, щоб пережити рестарт
+    global pending_worksheet
+    if pending_worksheet is None:
+        sh = gc.open_by_key(GOOGLE_SHEET_ID_ORDERS)
+        try:
+            worksheet = sh.worksheet(PENDING_WORKSHEET)
+        except gspread.exceptions.WorksheetNotFound:
+            worksheet = sh.add_worksheet(title=PENDING_WORKSHEET, rows=100, cols=3)
+            worksheet.append_row(["invoice_id", "order", "created_at"])
+        pending_worksheet = worksheet
+    return pending_worksheet
+
+def save_pending_order(invoice_id: str, order: dict):
+    with pending_sheet_lock:
+        get_pending_worksheet().append_row(
+            [invoice_id, json.dumps(order, ensure_ascii=False, default=str), order.get("created_at", "")]
+        )
+
+def delete_pending_order(invoice_id: str):
+    with pending_sheet_lock:
+        worksheet = get_pending_worksheet()
+        cell = worksheet.find(str(invoice_id), in_column=1)
+        if cell:
+            worksheet.delete_rows(cell.row)
+
+def load_pending_orders() -> int:
+    with pending_sheet_lock:
+        records = get_pending_worksheet().get_all_records()
+    now = time.time()
+    for row in records:
+        invoice_id = str(row.get("invoice_id", ""))
+        try:
+            order = json.loads(row.get("order") or "{}")
+        except ValueError:
+            logger.error(f"Пошкоджений запис pending для інвойсу {invoice_id}")
+            continue
+        if not invoice_id or invoice_id in pending_orders:
+            continue
+        pending_orders[invoice_id] = order
+        remaining = float(order.get("created_at") or 0) + HOLD_TTL_SECONDS - now
+        title = order.get("book", {}).get("title", "")
+        if remaining > 0 and not place_hold(order.get("hold_id", ""), order.get("location", ""), title, ttl=remaining):
+            logger.warning(f"Не вдалося відновити бронь для інвойсу {invoice_id}")
+    return len(records)
+
+async def forget_pending_order(invoice_id: str):
+    try:
+        await asyncio.to_thread(delete_pending_order, invoice_id)
+    except Exception as e:
+        logger.error(f"Не вдалося видалити pending-запис {invoice_id}: {e}", exc_info=True)
 
 async def save_order_to_sheets(data: dict) -> bool:
     try:
         worksheet = gc.open_by_key(GOOGLE_SHEET_ID_ORDERS).sheet1
+        header = ensure_orders_header(worksheet)
         location_str = data.get("location")
         if not location_str:
             book_title = data.get("book", {}).get("title", "")
@@ -129,20 +682,20 @@ async def save_order_to_sheets(data: dict) -> bool:
         author = book.get("author", "")
         kyiv_tz = ZoneInfo("Europe/Kyiv")
         order_datetime = datetime.now(kyiv_tz).isoformat(sep=' ', timespec='seconds')
-        worksheet.append_row(
-            [
-                location_str,
-                author,
-                book.get("title", ""),
-                data.get("genre", ""),
-                data.get("days", ""),
-                data.get("name", ""),
-                data.get("contact", ""),
-                order_datetime,
-                data.get("invoice_id", ""),
-                data.get("chat_id", ""),
-            ]
-        )
+        values = {
+            "location": location_str,
+            "author": author,
+            "title": book.get("title", ""),
+            "genre": resolve_genre(data.get("genre", ""), book.get("title", "")),
+            "days": data.get("days", ""),
+            "name": data.get("name", ""),
+            "contact": data.get("contact", ""),
+            "order_datetime": order_datetime,
+            "invoice_id": data.get("invoice_id", ""),
+            "chat_id": data.get("chat_id", ""),
+            "amount": data.get("amount", ""),
+        }
+        worksheet.append_row([values.get(column, "") for column in header])
         return True
     except Exception as e:
         logger.error(f"Помилка запису в Google Sheets: {e}", exc_info=True)
@@ -161,9 +714,19 @@ async def get_chat_id_for_order(invoice_id: str) -> int | None:
         logger.error(f"Error getting chat_id for invoice: {e}")
     return None
 
+def parse_copies(value, location: str, title: str) -> int:
+    if value is None or (not isinstance(value, str) and pd.isna(value)) or str(value).strip() == "":
+        return 1
+    try:
+        return max(int(float(str(value).strip().replace(",", "."))), 0)
+    except ValueError:
+        logger.warning(f"Некоректна кількість примірників \"{value}\" для \"{title}\" на \"{location}\", беремо 1")
+        return 1
+
 def load_data_from_google_sheet():
     global locations, genres, authors, book_data, rental_price_map
     global book_to_locations, location_to_books, author_to_books, author_normalized_map, author_to_books_normalized
+    global title_to_book
     sh = gc.open_by_key(GOOGLE_SHEET_ID_LOCATIONS)
     worksheet = sh.sheet1
     records = worksheet.get_all_records()
@@ -177,6 +740,8 @@ def load_data_from_google_sheet():
     book_data.clear()
     book_to_locations.clear()
     location_to_books.clear()
+    title_to_book = {}
+    totals = {}
     for genre in genres:
         books = []
         df_genre = df[df['genre'] == genre]
@@ -189,8 +754,10 @@ def load_data_from_google_sheet():
                 "author": author,
                 "price_7": row.get('price_7', 70),
                 "price_14": row.get('price_14', 140),
+                "genre": genre,
             }
             books.append(book)
+            title_to_book.setdefault(book["title"], book)
             if book["title"] not in book_to_locations:
                 book_to_locations[book["title"]] = []
             if row['location'] not in book_to_locations[book["title"]]:
@@ -200,7 +767,10 @@ def load_data_from_google_sheet():
                 location_to_books[loc] = []
             if book["title"] not in location_to_books[loc]:
                 location_to_books[loc].append(book["title"])
+            copies = parse_copies(row.get('copies', 1), loc, book["title"])
+            totals[(loc, book["title"])] = totals.get((loc, book["title"]), 0) + copies
         book_data[genre] = books
+    rebuild_availability(totals)
     if not df.empty:
         row0 = df.iloc[0]
         rental_price_map = {
@@ -210,6 +780,348 @@ def load_data_from_google_sheet():
     else:
         rental_price_map = {7: 70, 14: 140}
     logger.info(f"Дані завантажено: {len(locations)} локацій, {len(genres)} жанрів.")
+    schedule_recommendations_refresh()
+
+def group_pairs(groups) -> tuple:
+    # Усі впорядковані пари (i, j), i != j, всередині кожної групи
+    rows, cols = [], []
+    for group in groups:
+        if len(group) < 2:
+            continue
+        members = np.asarray(group, dtype=np.int64)
+        r = np.repeat(members, members.size)
+        c = np.tile(members, members.size)
+        mask = r != c
+        rows.append(r[mask])
+        cols.append(c[mask])
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+def compute_recommendations(catalog: list) -> tuple:
+    # Виконується у потоці: лише розріджені пари (рядок, стовпець, вага), без матриць n x n
+    titles = list(dict.fromkeys(title for _, title, _ in catalog))
+    n = len(titles)
+    if n < 2:
+        return {}, 0
+    index = {t: i for i, t in enumerate(titles)}
+    author_groups = {}
+    for _, title, author in catalog:
+        if author:
+            author_groups.setdefault(author, set()).add(index[title])
+    with orders_ingest_lock:
+        baskets = [[index[t] for t in rented if t in index] for rented in chat_rentals.values()]
+    codes, weights = [], []
+    rows, cols = group_pairs(baskets)
+    if rows.size:
+        # Косинусна схожість за спільними орендами
+        counts = np.bincount(np.concatenate([np.asarray(b, dtype=np.int64) for b in baskets if b]), minlength=n)
+        pair_codes, co = np.unique(rows * n + cols, return_counts=True)
+        i, j = np.divmod(pair_codes, n)
+        codes.append(pair_codes)
+        weights.append(co / np.sqrt(counts[i] * counts[j]))
+    # Той самий жанр не зберігаємо парами (це g² на жанр) — ним добирає recommended_titles
+    rows, cols = group_pairs([sorted(g) for g in author_groups.values()])
+    if rows.size:
+        pair_codes = np.unique(rows * n + cols)
+        codes.append(pair_codes)
+        weights.append(np.full(pair_codes.size, RECOMMEND_AUTHOR_WEIGHT))
+    if not codes:
+        return {}, len(baskets)
+    pair_codes, inverse = np.unique(np.concatenate(codes), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(weights))
+    rows, cols = np.divmod(pair_codes, n)
+    order = np.lexsort((-scores, rows))
+    rows, cols = rows[order], cols[order]
+    rank = np.arange(rows.size) - np.searchsorted(rows, rows, side="left")
+    keep = rank < RECOMMEND_TOP_K
+    table = {}
+    for i, j in zip(rows[keep].tolist(), cols[keep].tolist()):
+        table.setdefault(titles[i], []).append(titles[j])
+    return table, len(baskets)
+
+async def refresh_recommendations():
+    global recommendations, recommendations_signature
+    while True:
+        catalog = [
+            (genre, b["title"], normalize_str(b.get("author", "")))
+            for genre, books in book_data.items() for b in books
+        ]
+        signature = (hash(tuple(catalog)), orders_rows_read)
+        if signature == recommendations_signature:
+            return
+        table, readers = await asyncio.to_thread(compute_recommendations, catalog)
+        recommendations = table
+        recommendations_signature = signature
+        logger.info(f"Рекомендації перебудовано: {len(table)} книг, {readers} читачів")
+
+def schedule_recommendations_refresh():
+    global recommendations_task
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    if recommendations_task is None or recommendations_task.done():
+        recommendations_task = asyncio.create_task(run_recommendations_refresh())
+
+async def run_recommendations_refresh():
+    try:
+        await refresh_recommendations()
+    except Exception as e:
+        logger.error(f"Помилка перебудови рекомендацій: {e}", exc_info=True)
+
+def recommended_titles(title: str, location: str | None = None) -> list[str]:
+    picks = [t for t in recommendations.get(title, []) if is_available(t, location)][:RECOMMEND_SHOWN]
+    if len(picks) < RECOMMEND_SHOWN:
+        genre = title_to_book.get(title, {}).get("genre")
+        for b in book_data.get(genre, []):
+            candidate = b["title"]
+            if candidate != title and candidate not in picks and is_available(candidate, location):
+                picks.append(candidate)
+                if len(picks) == RECOMMEND_SHOWN:
+                    break
+    return picks
+
+async def orders_refresh_loop():
+    while True:
+        try:
+            added = await asyncio.to_thread(ingest_new_orders)
+            if added:
+                stats_cache["at"] = 0.0
+                await refresh_recommendations()
+        except Exception as e:
+            logger.error(f"Помилка оновлення замовлень: {e}", exc_info=True)
+        await asyncio.sleep(ORDERS_REFRESH_INTERVAL)
+
+def is_admin(update: Update) -> bool:
+    return bool(ADMIN_CHAT_ID) and update.effective_chat is not None and str(update.effective_chat.id) == ADMIN_CHAT_ID
+
+def iter_new_order_rows():
+    # Читаємо лише нові рядки, шматками по STATS_CHUNK_ROWS
+    global orders_rows_read
+    worksheet = gc.open_by_key(GOOGLE_SHEET_ID_ORDERS).sheet1
+    ensure_orders_header(worksheet)
+    while True:
+        start = orders_rows_read + 2
+        end = start + STATS_CHUNK_ROWS - 1
+        chunk = worksheet.get(f"A{start}:{gspread.utils.rowcol_to_a1(end, len(orders_header))}")
+        if not chunk:
+            return
+        orders_rows_read += len(chunk)
+        for values in chunk:
+            if values:
+                yield dict(zip(orders_header, values))
+        if len(chunk) < STATS_CHUNK_ROWS:
+            return
+
+def resolve_genre(genre: str, title: str) -> str:
+    # "all" / "all_location" — це режими перегляду, а не жанри
+    if genre in ("", "all", "all_location"):
+        return title_to_book.get(title, {}).get("genre", genre)
+    return genre
+
+def order_revenue(row: dict) -> int:
+    amount = str(row.get("amount", "")).strip()
+    if amount:
+        try:
+            return int(float(amount))
+        except ValueError:
+            pass
+    # Старі рядки без amount: ціна з поточного каталогу
+    try:
+        days = int(row.get("days") or 0)
+    except ValueError:
+        return 0
+    book = title_to_book.get(row.get("title", ""), {})
+    price = book.get(f"price_{days}", rental_price_map.get(days, 0))
+    try:
+        return int(price)
+    except (TypeError, ValueError):
+        return 0
+
+def _bump(bucket: dict, key, revenue: int):
+    entry = bucket.setdefault(key or "—", {"rentals": 0, "revenue": 0})
+    entry["rentals"] += 1
+    entry["revenue"] += revenue
+
+def aggregate_order_row(row: dict):
+    revenue = order_revenue(row)
+    dt = parse_order_datetime(row.get("order_datetime", ""))
+    order_stats["total"]["rentals"] += 1
+    order_stats["total"]["revenue"] += revenue
+    _bump(order_stats["location"], row.get("location", ""), revenue)
+    _bump(order_stats["genre"], resolve_genre(row.get("genre", ""), row.get("title", "")), revenue)
+    _bump(order_stats["title"], row.get("title", ""), revenue)
+    _bump(order_stats["day"], dt.date().isoformat() if dt else "", revenue)
+    chat_id = str(row.get("chat_id", "")).strip()
+    if chat_id and row.get("title"):
+        chat_rentals.setdefault(chat_id, set()).add(row["title"])
+
+def ingest_new_orders() -> int:
+    added = 0
+    with orders_ingest_lock:
+        for row in iter_new_order_rows():
+            aggregate_order_row(row)
+            added += 1
+    return added
+
+def stats_snapshot() -> dict:
+    def ranked(bucket):
+        return dict(sorted(bucket.items(), key=lambda kv: kv[1]["revenue"], reverse=True))
+    with orders_ingest_lock:
+        return {
+            "total": dict(order_stats["total"]),
+            "location": ranked(order_stats["location"]),
+            "genre": ranked(order_stats["genre"]),
+            "title": ranked(order_stats["title"]),
+            "day": dict(sorted(order_stats["day"].items())),
+            "rows_read": orders_rows_read,
+        }
+
+async def get_order_stats() -> dict:
+    if stats_cache["data"] is not None and time.time() - stats_cache["at"] < STATS_CACHE_TTL:
+        return stats_cache["data"]
+    added = await asyncio.to_thread(ingest_new_orders)
+    if added:
+        logger.info(f"Аналітика: додано {added} нових замовлень")
+        schedule_recommendations_refresh()
+    stats_cache["data"] = stats_snapshot()
+    stats_cache["at"] = time.time()
+    return stats_cache["data"]
+
+def format_stats_top(title: str, bucket: dict, limit: int = 5) -> str:
+    lines = [title]
+    for key, value in list(bucket.items())[:limit]:
+        lines.append(f"  {key}: {value['rentals']} оренд, {value['revenue']} грн")
+    return "\n".join(lines)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    try:
+        stats = await get_order_stats()
+    except Exception as e:
+        logger.error(f"Помилка розрахунку статистики: {e}", exc_info=True)
+        await update.message.reply_text("Не вдалося порахувати статистику. Спробуйте пізніше.")
+        return
+    last_days = dict(list(stats["day"].items())[-7:])
+    text = "\n\n".join([
+        f"📊 Усього: {stats['total']['rentals']} оренд, {stats['total']['revenue']} грн",
+        format_stats_top("🏠 Локації:", stats["location"]),
+        format_stats_top("🗂 Жанри:", stats["genre"]),
+        format_stats_top("📖 Книги:", stats["title"]),
+        format_stats_top("📆 Останні дні:", last_days, limit=7),
+    ])
+    await update.message.reply_text(text)
+
+def check_api_token(request) -> bool:
+    # Лише заголовок: query-рядок потрапляє в access log
+    token = request.headers.get("X-Stats-Token", "")
+    return bool(STATS_API_TOKEN) and hmac.compare_digest(token.encode(), STATS_API_TOKEN.encode())
+
+async def stats_json_handler(request):
+    if not check_api_token(request):
+        return web.Response(text="Forbidden", status=403)
+    try:
+        stats = await get_order_stats()
+    except Exception as e:
+        logger.error(f"Помилка розрахунку статистики: {e}", exc_info=True)
+        return web.json_response({"error": str(e)}, status=500)
+    return web.json_response(stats, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+def log_trace(kind: str, ref, trace: dict, total: float):
+    logger.info(
+        "trace kind=%s ref=%s total_ms=%.1f handler_ms=%.1f sheets_ms=%.1f monopay_ms=%.1f bot_api_ms=%.1f",
+        kind, ref, total * 1000,
+        (total - sum(trace.values())) * 1000,
+        trace.get("sheets", 0.0) * 1000,
+        trace.get("monopay", 0.0) * 1000,
+        trace.get("bot_api", 0.0) * 1000,
+    )
+
+async def run_profile_capture(bot, chat_id: int, seconds: int):
+    global profile_capture_task, last_profile_report
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        profile_capture_task = None
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(60)
+    last_profile_report = out.getvalue()
+    filename = f"profile-{datetime.now(ZoneInfo('Europe/Kyiv')).strftime('%Y%m%d-%H%M%S')}.txt"
+    try:
+        await bot.send_document(chat_id, document=io.BytesIO(last_profile_report.encode()), filename=filename)
+    except Exception as e:
+        logger.error(f"Не вдалося надіслати звіт профілювання: {e}")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global profiling_enabled, webhook_log_sample_rate, profile_capture_task
+    if not is_admin(update):
+        return
+    args = context.args or []
+    action = args[0] if args else "status"
+    if action == "on":
+        profiling_enabled = True
+    elif action == "off":
+        profiling_enabled = False
+    elif action == "sample" and len(args) > 1:
+        try:
+            webhook_log_sample_rate = min(max(float(args[1]), 0.0), 1.0)
+        except ValueError:
+            await update.message.reply_text("Використання: /profile sample 0.1")
+            return
+    elif action == "capture":
+        if profile_capture_task is not None:
+            await update.message.reply_text("Профілювання вже триває.")
+            return
+        seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else 30
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+        profile_capture_task = asyncio.create_task(
+            run_profile_capture(context.bot, update.effective_chat.id, seconds)
+        )
+        await update.message.reply_text(f"Знімаю профіль {seconds} с, звіт прийде файлом.")
+        return
+    elif action != "status":
+        await update.message.reply_text("Використання: /profile on|off|status|sample <0..1>|capture <сек>")
+        return
+    await update.message.reply_text(
+        f"Трасування: {'увімкнено' if profiling_enabled else 'вимкнено'}\n"
+        f"Частка логів вебхуків: {webhook_log_sample_rate}\n"
+        f"Профілювання: {'триває' if profile_capture_task is not None else 'не запущено'}\n"
+        f"Редагувань повідомлень: {render_stats['sent']}, пропущено без змін: {render_stats['skipped']}"
+    )
+
+async def profile_report_handler(request):
+    if not check_api_token(request):
+        return web.Response(text="Forbidden", status=403)
+    if not last_profile_report:
+        return web.Response(text="No profile captured yet", status=404)
+    return web.Response(text=last_profile_report, content_type="text/plain")
+
+async def returned_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    if not context.args:
+        await update.message.reply_text("Використання: /returned <invoice_id>")
+        return
+    invoice_id = context.args[0]
+    key = release_rental(invoice_id)
+    try:
+        marked = await asyncio.to_thread(
+            mark_orders, "returned_at", [invoice_id],
+            datetime.now(ZoneInfo("Europe/Kyiv")).isoformat(sep=' ', timespec='seconds'),
+        )
+    except Exception as e:
+        logger.error(f"Помилка запису повернення {invoice_id}: {e}", exc_info=True)
+        marked = 0
+    if not key and not marked:
+        await update.message.reply_text(f"Оренду {invoice_id} не знайдено.")
+        return
+    title = f"«{key[1]}» на поличці \"{key[0]}\"" if key else invoice_id
+    await update.message.reply_text(f"✅ Повернення зафіксовано: {title}")
 
 async def reload_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -240,11 +1152,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
     elif update.callback_query:
         await update.callback_query.answer()
-        try:
-            await update.callback_query.edit_message_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(update.callback_query, welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
     context.user_data["location_page"] = 0
     return CHOOSE_LOCATION
 
@@ -259,34 +1167,28 @@ async def choose_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["location_page"] = next_page
         keyboard = get_paginated_buttons(locations, next_page, "location", locations_per_page, add_start_button=True)
         keyboard.append([InlineKeyboardButton("📚 Показати всі книги", callback_data="all_books")])
-        try:
-            await query.edit_message_text(
-                "Оберіть локацію:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(
+            query,
+            "Оберіть локацію:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
         return CHOOSE_LOCATION
     if data == "location_prev":
         prev_page = max(current_page - 1, 0)
         context.user_data["location_page"] = prev_page
         keyboard = get_paginated_buttons(locations, prev_page, "location", locations_per_page, add_start_button=True)
         keyboard.append([InlineKeyboardButton("📚 Показати всі книги", callback_data="all_books")])
-        try:
-            await query.edit_message_text(
-                "Оберіть локацію:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(
+            query,
+            "Оберіть локацію:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
         return CHOOSE_LOCATION
     loc_selected = data.split(":", 1)[1]
     context.user_data["location"] = loc_selected
-    loc_books_titles = location_to_books.get(loc_selected, [])
+    loc_books_titles = [t for t in location_to_books.get(loc_selected, []) if is_available(t, loc_selected)]
     if not loc_books_titles:
-        await query.edit_message_text(f"На локації \"{loc_selected}\" немає доступних книг.")
+        await edit_message_cached(query, f"На локації \"{loc_selected}\" немає доступних книг.")
         return CHOOSE_LOCATION
     genres_in_location_set = set()
     for genre, books in book_data.items():
@@ -306,7 +1208,7 @@ async def show_genres_for_location(update: Update, context: ContextTypes.DEFAULT
     genres_loc = context.user_data.get("location_genres", [])
     loc = context.user_data.get("location", "")
     if not genres_loc:
-        await query.edit_message_text(f"На локації \"{loc}\" немає доступних жанрів.")
+        await edit_message_cached(query, f"На локації \"{loc}\" немає доступних жанрів.")
         return CHOOSE_LOCATION
     keyboard = [[InlineKeyboardButton(genre, callback_data=f"genre:{genre}")] for genre in genres_loc]
     keyboard.append([InlineKeyboardButton("📚 Показати всі книги на локації", callback_data="genre:all_location")])
@@ -314,7 +1216,8 @@ async def show_genres_for_location(update: Update, context: ContextTypes.DEFAULT
         [InlineKeyboardButton("🔙 Назад до локацій", callback_data="back:locations"),
          InlineKeyboardButton("🏠 На початок", callback_data="back:start")]
     )
-    await query.edit_message_text(
+    await edit_message_cached(
+        query,
         "А тепер — трохи магії! Який жанр сьогодні відгукується твоєму настрою?\n\n"
         "Любиш щось глибоке? Може, пригодницьке? А може — спокійний нон-фікшн на вечір?\n",
         reply_markup=InlineKeyboardMarkup(keyboard),
@@ -329,19 +1232,19 @@ async def choose_genre(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if genre == "all_location":
         loc_book_titles = context.user_data.get("location_books", [])
         if not loc_book_titles:
-            await query.edit_message_text(f"На локації \"{loc}\" немає доступних книг.")
+            await edit_message_cached(query, f"На локації \"{loc}\" немає доступних книг.")
             return ConversationHandler.END
         
         books_list = []
         added_titles = set()
         for genre_books in book_data.values():
             for b in genre_books:
-                if b["title"] in loc_book_titles and b["title"] not in added_titles:
+                if b["title"] in loc_book_titles and b["title"] not in added_titles and is_available(b["title"], loc):
                     books_list.append(b)
                     added_titles.add(b["title"])
         
         if not books_list:
-            await query.edit_message_text(f"На локації \"{loc}\" немає доступних книг.")
+            await edit_message_cached(query, f"На локації \"{loc}\" немає доступних книг.")
             return ConversationHandler.END
         
         context.user_data["genre"] = "all_location"
@@ -353,13 +1256,9 @@ async def choose_genre(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if loc:
         loc_books_titles = location_to_books.get(loc, [])
         genre_books = book_data.get(genre, [])
-        filtered_books = [b for b in genre_books if b["title"] in loc_books_titles]
+        filtered_books = [b for b in genre_books if b["title"] in loc_books_titles and is_available(b["title"], loc)]
         if not filtered_books:
-            try:
-                await query.edit_message_text("Немає книг у цьому жанрі на цій локації.")
-            except BadRequest as e:
-                if "Message is not modified" not in str(e):
-                    raise
+            await edit_message_cached(query, "Немає книг у цьому жанрі на цій локації.")
             return ConversationHandler.END
         context.user_data["genre"] = genre
         context.user_data["books"] = filtered_books
@@ -367,13 +1266,9 @@ async def choose_genre(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_books(update, context)
         return SHOW_BOOKS
     else:
-        genre_books = book_data.get(genre, [])
+        genre_books = [b for b in book_data.get(genre, []) if is_available(b["title"])]
         if not genre_books:
-            try:
-                await query.edit_message_text("Немає книг у цьому жанрі.")
-            except BadRequest as e:
-                if "Message is not modified" not in str(e):
-                    raise
+            await edit_message_cached(query, "Немає книг у цьому жанрі.")
             return ConversationHandler.END
         context.user_data["genre"] = genre
         context.user_data["books"] = genre_books
@@ -414,11 +1309,7 @@ async def show_books(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("🏠 На початок", callback_data="back:start"),
         ]
     )
-    try:
-        await query.edit_message_text("Подивимось, що тут у нас:", reply_markup=InlineKeyboardMarkup(buttons))
-    except BadRequest as e:
-        if "Message is not modified" not in str(e):
-            raise
+    await edit_message_cached(query, "Подивимось, що тут у нас:", reply_markup=InlineKeyboardMarkup(buttons))
     return SHOW_BOOKS
 
 async def book_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -441,11 +1332,7 @@ async def book_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     book_hash_map = context.user_data.get("book_hash_map", {})
     book_title = book_hash_map.get(book_hash)
     if not book_title:
-        try:
-            await query.edit_message_text("Книгу не знайдено (неправильний код).")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(query, "Книгу не знайдено (неправильний код).")
         return SHOW_BOOKS
     genre = context.user_data.get("genre", "")
     current_books = context.user_data.get("books", [])
@@ -461,11 +1348,7 @@ async def book_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
             genre_books = book_data.get(genre, [])
             book = next((b for b in genre_books if b["title"] == book_title), None)
     if not book:
-        try:
-            await query.edit_message_text("Книгу не знайдено.")
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(query, "Книгу не знайдено.")
         return SHOW_BOOKS
 
     context.user_data["book"] = book
@@ -474,6 +1357,12 @@ async def book_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     desc = book.get("desc", "Опис відсутній")
     book_genre = context.user_data.get("genre", "Жанр не вказано")
     book_info = f"Автор: {author}\nНазва: {title}\nЖанр: {book_genre}\nОпис: {desc}\n\n"
+    also_like = recommended_titles(title, context.user_data.get("location"))
+    if also_like:
+        book_info += "Вам також може сподобатися:\n" + "\n".join(
+            f"• {t} ({title_to_book[t].get('author')})" if title_to_book.get(t, {}).get("author") else f"• {t}"
+            for t in also_like
+        ) + "\n"
 
     buttons = [
         [InlineKeyboardButton("Я точно хочу цю книгу", callback_data="confirm_book")],
@@ -484,7 +1373,8 @@ async def book_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ],
     ]
 
-    await query.edit_message_text(
+    await edit_message_cached(
+        query,
         "Детальніше про книгу:\n\n" + book_info,
         reply_markup=InlineKeyboardMarkup(buttons),
     )
@@ -494,7 +1384,8 @@ async def book_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def book_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await edit_message_cached(
+        query,
         "О, чудовий вибір! Ця книга — справжня перлина 🌼\n\n"
         "Вона знайшла тебе не випадково. Хай читається легко, а думки розпускаються, як чай у теплій чашці.\n\n"
         "А тепер попрошу трішки про тебе. Залиш свої прізвище та імʼя, а також номер телефону (щоб ми могли тримати зв’язок, якщо що)\n\n"
@@ -532,24 +1423,39 @@ async def days_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["days"] = str(days)
     data = context.user_data
     location = data.get("location")
-    book = data.get("book", {})
+    # Власна копія: словники книг спільні з каталогом book_data
+    book = dict(data.get("book", {}))
+    data["book"] = book
     author = book.get("author", "")
     genre = data.get("genre")
+    book_title = book.get("title", "")
     if not location:
-        book_title = book.get("title", "")
-        locations_list = book_to_locations.get(book_title, [])
-        location = ", ".join(locations_list) if locations_list else ""
+        location = pick_location_with_copy(book_title)
         data["location"] = location
     invoice_uuid = str(uuid.uuid4())
+    if not location or not place_hold(invoice_uuid, location, book_title):
+        buttons = [[InlineKeyboardButton("🏠 На початок", callback_data="back:start")]]
+        await edit_message_cached(
+            query,
+            "На жаль, усі примірники цієї книги зараз зайняті. Спробуй обрати іншу 🌿",
+            reply_markup=InlineKeyboardMarkup(buttons),
+        )
+        return ConversationHandler.END
+    data["hold_id"] = invoice_uuid
     description = f"Оренда книги {data['book']['title']} на {days} днів"
     price_total = book.get(f'price_{days}', rental_price_map.get(days, 70))
-    data["book"]["price"] = price_total
+    data["amount"] = int(float(price_total))
     data["invoice_id"] = None
     data["chat_id"] = query.message.chat.id
     try:
         invoice_url, invoice_id = await create_monopay_invoice(price_total, description, invoice_uuid)
         data["invoice_id"] = invoice_id
-        pending_orders[invoice_id] = data.copy()
+        data["created_at"] = time.time()
+        pending_orders[invoice_id] = {field: data.get(field) for field in PENDING_ORDER_FIELDS}
+        try:
+            await asyncio.to_thread(save_pending_order, invoice_id, pending_orders[invoice_id])
+        except Exception as e:
+            logger.error(f"Не вдалося зберегти pending-замовлення {invoice_id}: {e}", exc_info=True)
         buttons = [
             [InlineKeyboardButton("💳 Оплатити MonoPay", url=invoice_url)],
             [InlineKeyboardButton("🏠 На початок", callback_data="back:start")],
@@ -566,19 +1472,84 @@ async def days_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"\nСума до оплати: <b>{price_total} грн</b>\n\n"
             f"Натисніть кнопку нижче, щоб оплатити."
         )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode="HTML")
+        await edit_message_cached(query, text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode="HTML")
     except Exception as e:
         logger.error(f"Помилка створення інвойсу MonoPay: {e}")
+        if not data.get("invoice_id"):
+            release_hold(invoice_uuid)
         buttons = [[InlineKeyboardButton("🏠 На початок", callback_data="back:start")]]
-        await query.edit_message_text(f"Помилка при створенні платежу: {e}", reply_markup=InlineKeyboardMarkup(buttons))
+        await edit_message_cached(query, f"Помилка при створенні платежу: {e}", reply_markup=InlineKeyboardMarkup(buttons))
         return ConversationHandler.END
     return CONFIRMATION
 
+async def complete_paid_order(invoice_id: str, bot) -> bool:
+    order_data = pending_orders.pop(invoice_id, None)
+    if not order_data:
+        logger.warning(f"No pending order found for invoice {invoice_id}, skipping saving to Sheets")
+        return False
+    await forget_pending_order(invoice_id)
+    location = order_data.get("location", "")
+    title = order_data.get("book", {}).get("title", "")
+    due_at = convert_hold_to_rental(
+        order_data.get("hold_id", ""),
+        invoice_id,
+        location,
+        title,
+        int(order_data.get("days") or 0),
+    )
+    if available_copies(location, title) < 0:
+        await notify_admin(
+            bot,
+            f"⚠️ Оплачено більше примірників, ніж є: «{title}» на локації \"{location}\" "
+            f"(інвойс {invoice_id}). Перевірте поличку.",
+        )
+    saved = await save_order_to_sheets(order_data)
+    if not saved:
+        logger.error(f"Failed to save order to sheets for invoice {invoice_id}")
+    stats_cache["at"] = 0.0
+    chat_id = order_data.get("chat_id")
+    if chat_id:
+        schedule_rental_reminders(
+            invoice_id,
+            chat_id,
+            order_data.get("book", {}).get("title", ""),
+            order_data.get("location", ""),
+            due_at,
+        )
+        text = (
+            "✅ Все готово! Обійми книжку, забери її з полички — і насолоджуйся кожною сторінкою.\n"
+            "Нехай ця історія буде саме тією, яку тобі зараз потрібно.\n"
+            "З любов’ю до читання, Тиха поличка і я — Ботик-книголюб 🤍"
+        )
+        buttons = [
+            [InlineKeyboardButton("🏠 На початок", callback_data="back:start")]
+        ]
+        try:
+            await bot.send_message(
+                chat_id,
+                text,
+                reply_markup=InlineKeyboardMarkup(buttons)
+            )
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати повідомлення в Telegram: {e}")
+    else:
+        logger.warning(f"Chat ID for invoice {invoice_id} not found")
+    return True
+
+async def fail_pending_order(invoice_id: str, payment_status: str):
+    order_data = pending_orders.pop(invoice_id, None)
+    if not order_data:
+        return
+    await forget_pending_order(invoice_id)
+    if release_hold(order_data.get("hold_id", "")):
+        logger.info(f"Hold released for invoice {invoice_id} (status={payment_status})")
+
 async def monopay_webhook(request):
     try:
         body = await request.text()
         data = json.loads(body)
-        logger.info(f"Full webhook data received from MonoPay:\n{json.dumps(data, indent=2, ensure_ascii=False)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("MonoPay webhook payload: %s", body)
         signature = request.headers.get("X-Signature-MonoPay")
         if MONOPAY_WEBHOOK_SECRET and signature:
             computed_signature = hmac.new(
@@ -591,46 +1562,75 @@ async def monopay_webhook(request):
                 return web.Response(text="Invalid signature", status=403)
         invoice_id = data.get("invoiceId")
         payment_status = data.get("status")
-        logger.info(f"MonoPay webhook received: invoiceId={invoice_id}, status={payment_status}")
-        if payment_status in {"PAID", "success"}:
-            order_data = pending_orders.pop(invoice_id, None)
-            if order_data:
-                saved = await save_order_to_sheets(order_data)
-                if not saved:
-                    logger.error(f"Failed to save order to sheets for invoice {invoice_id}")
-                chat_id = order_data.get("chat_id")
-                if chat_id:
-                    text = (
-                        "✅ Все готово! Обійми книжку, забери її з полички — і насолоджуйся кожною сторінкою.\n"
-                        "Нехай ця історія буде саме тією, яку тобі зараз потрібно.\n"
-                        "З любов’ю до читання, Тиха поличка і я — Ботик-книголюб 🤍"
-                    )
-                    buttons = [
-                        [InlineKeyboardButton("🏠 На початок", callback_data="back:start")]
-                    ]
-                    try:
-                        await request.app.bot_updater.bot.send_message(
-                            chat_id,
-                            text,
-                            reply_markup=InlineKeyboardMarkup(buttons)
-                        )
-                    except Exception as e:
-                        logger.error(f"Не вдалося надіслати повідомлення в Telegram: {e}")
-                else:
-                    logger.warning(f"Chat ID for invoice {invoice_id} not found")
-            else:
-                logger.warning(f"No pending order found for invoice {invoice_id}, skipping saving to Sheets")
+        if should_log_webhook():
+            logger.info("monopay_webhook invoice_id=%s status=%s", invoice_id, payment_status)
+        token = current_trace.set({}) if profiling_enabled else None
+        t0 = time.perf_counter()
+        try:
+            if payment_status in {"PAID", "success"}:
+                await complete_paid_order(invoice_id, request.app.bot_updater.bot)
+            elif payment_status in {"failure", "expired", "reversed"}:
+                await fail_pending_order(invoice_id, payment_status)
+        finally:
+            if token is not None:
+                log_trace("monopay", invoice_id, current_trace.get(), time.perf_counter() - t0)
+                current_trace.reset(token)
         return web.Response(text="OK")
     except Exception as e:
         logger.exception("Error in MonoPay webhook:")
         return web.Response(text=f"Error: {e}", status=500)
 
+async def reconcile_pending_orders(bot) -> dict:
+    # Підбираємо оплати, вебхук яких до нас не дійшов
+    cutoff = time.time() - RECONCILE_MIN_AGE_MINUTES * 60
+    stale = [inv for inv, order in list(pending_orders.items()) if order.get("created_at", 0) <= cutoff]
+    results = {}
+    if not stale:
+        return results
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def check(invoice_id):
+        async with semaphore:
+            try:
+                results[invoice_id] = await fetch_monopay_invoice_status(invoice_id)
+            except Exception as e:
+                logger.error(f"Не вдалося перевірити статус інвойсу {invoice_id}: {e}")
+                results[invoice_id] = None
+
+    await asyncio.gather(*(check(inv) for inv in stale))
+    for invoice_id, status in results.items():
+        if status == "success":
+            logger.info(f"Reconciler: invoice {invoice_id} paid, completing order")
+            await complete_paid_order(invoice_id, bot)
+        elif status in {"failure", "expired", "reversed"}:
+            await fail_pending_order(invoice_id, status)
+    return results
+
+async def monopay_reconciler(bot):
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            results = await reconcile_pending_orders(bot)
+            if results:
+                logger.info(f"Reconciler перевірив {len(results)} інвойсів")
+        except Exception as e:
+            logger.error(f"Помилка звірки інвойсів MonoPay: {e}", exc_info=True)
+
 async def telegram_webhook_handler(request):
     app = request.app
     bot_app = app.bot_updater
     body = await request.text()
     update = Update.de_json(json.loads(body), bot_app.bot)
-    await bot_app.process_update(update)
+    if not profiling_enabled:
+        await bot_app.process_update(update)
+        return web.Response(text="OK", status=200)
+    token = current_trace.set({})
+    t0 = time.perf_counter()
+    try:
+        await bot_app.process_update(update)
+    finally:
+        log_trace("update", update.update_id, current_trace.get(), time.perf_counter() - t0)
+        current_trace.reset(token)
     return web.Response(text="OK", status=200)
 
 async def success_page_handler(request):
@@ -695,11 +1695,7 @@ async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         keyboard = get_paginated_buttons(locations, 0, "location", locations_per_page, add_start_button=True)
         keyboard.append([InlineKeyboardButton("📚 Показати всі книги", callback_data="all_books")])
-        try:
-            await query.edit_message_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(query, welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
         return CHOOSE_LOCATION
     if data == "back:start":
         context.user_data.clear()
@@ -714,11 +1710,7 @@ async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         keyboard = get_paginated_buttons(locations, 0, "location", locations_per_page, add_start_button=True)
         keyboard.append([InlineKeyboardButton("📚 Показати всі книги", callback_data="all_books")])
-        try:
-            await query.edit_message_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
-        except BadRequest as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_message_cached(query, welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
         return CHOOSE_LOCATION
 
 async def start_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -728,9 +1720,9 @@ async def start_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if data == "all_books":
         books_all = []
         for genre_books in book_data.values():
-            books_all.extend(genre_books)
+            books_all.extend(b for b in genre_books if is_available(b["title"]))
         if not books_all:
-            await query.edit_message_text("Немає доступних книг.")
+            await edit_message_cached(query, "Немає доступних книг.")
             return ConversationHandler.END
         unique_books = {}
         for b in books_all:
@@ -744,7 +1736,7 @@ async def start_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def init_app():
     load_data_from_google_sheet()
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).request(TracingRequest(connection_pool_size=256)).build()
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -785,13 +1777,32 @@ async def init_app():
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("reload", reload_data))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("returned", returned_command))
     await application.initialize()
     await application.start()
+    start_background_task(availability_sweeper(application.bot))
+    try:
+        loaded = load_active_rentals_from_orders()
+        logger.info(f"Завантажено активних оренд: {loaded}, нагадувань у черзі: {len(reminder_heap)}")
+    except Exception as e:
+        logger.error(f"Помилка завантаження активних оренд: {e}", exc_info=True)
+    start_background_task(reminder_scheduler(application.bot))
+    try:
+        restored = load_pending_orders()
+        logger.info(f"Відновлено неоплачених замовлень: {restored}")
+    except Exception as e:
+        logger.error(f"Помилка відновлення неоплачених замовлень: {e}", exc_info=True)
+    start_background_task(monopay_reconciler(application.bot))
+    start_background_task(orders_refresh_loop())
     app = web.Application()
     app.router.add_get("/", lambda request: web.Response(text="OK", status=200))
     app.router.add_post("/telegram_webhook", telegram_webhook_handler)
     app.router.add_post("/monopay_callback", monopay_webhook)
     app.router.add_get("/success", success_page_handler)
+    app.router.add_get("/stats.json", stats_json_handler)
+    app.router.add_get("/profile_report", profile_report_handler)
     app.bot_updater = application
     runner = web.AppRunner(app)
     await runner.setup()
@@ -810,6 +1821,8 @@ if __name__ == "__main__":
         loop.run_forever()
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+        loop.run_until_complete(stop_background_tasks())
         loop.run_until_complete(application.stop())
         loop.run_until_complete(application.shutdown())
+        loop.run_until_complete(close_monopay_session())
 